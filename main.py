@@ -17,116 +17,192 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os       # To use shell commands
+import os       # To access the environment variables
 import typing   # Type hinting
 import click    # For creating a neat command line interface with options / flags
 import re       # Regular expressions
+import functools    # Partial function application and caching
+import subprocess   # To run xfconf-query without going through a shell
+from concurrent.futures import ThreadPoolExecutor # To run several xfconf-query processes at once
 
-def get_channel_header(channel_name : str) -> str:
-    """Returns a nice header for the current channel in the output script."""
-    header : str = "#\n"
-    header += "#    Channel: " + channel_name + "\n"
-    header += "#\n"
-    return header
+# Maximum number of xfconf-query processes running at the same time
+MAX_WORKERS : int = 16
 
-def get_needed_channels(get_all : bool) -> list[str]:
-    """Get the specified channels using the shell command xfconf-query."""
-    all_channels : list[str] = []
-    needed_channels : list[str] = []
-    all_channels = os.popen("xfconf-query -l").read().splitlines()
-    all_channels.pop(0) # First line just reads "Channels:", unneeded
-    for i in range(len(all_channels)):
-        all_channels[i] = all_channels[i].strip()
-
-    # Get all channels
-    if get_all == True:
-        needed_channels = all_channels
-    # Only get channels for "visual" configurations
-    else:
-        visuals_channels : list[str] = ["xfce4-desktop", "xfce4-panel", "xfce4-terminal", "xfwm4", "xsettings", "xfce4-notifyd"]
-        # Check if these channels are available on the current system
-        for c in visuals_channels:
-            if c in all_channels:
-                needed_channels.append(c)
+# Environment used for running xfconf-query, so its output doesn't depend on the user's language
+# C.UTF-8 rather than C, so values containing non-ASCII characters are printed unchanged
+XFCONF_ENVIRONMENT : dict[str, str] = dict(os.environ, LC_ALL="C.UTF-8")
+# LANGUAGE would still take precedence over LC_ALL for translated messages
+XFCONF_ENVIRONMENT.pop("LANGUAGE", None)
+
+# Start of the value of a property holding an array, as printed by xfconf-query
+ARRAY_VALUE_PREFIX : str = "Value is an array with"
+
+# Size of the buffer used when writing the script to a file (1 MiB)
+WRITE_BUFFER_SIZE : int = 1 << 20
+
+# Channels holding "visual" configurations
+VISUAL_CHANNELS : frozenset[str] = frozenset({"xfce4-desktop", "xfce4-panel", "xfce4-terminal", "xfwm4", "xsettings", "xfce4-notifyd"})
 
-    return needed_channels
+# Translation tables used for escaping characters in a single pass
+ANGLE_BRACKETS_TABLE : dict[int, str] = str.maketrans({"<": "\\<", ">": "\\>"})
+DOUBLE_QUOTE_TABLE : dict[int, str] = str.maketrans({"\"": "\\\""})
 
-def get_all_properties_of_channel(channel_name : str) -> list[str]:
-    """Get all available properties for the specified channel"""
-    # Get all properties in the form of a list
-    result : list[str] = os.popen("xfconf-query -c " + channel_name + " -l").read().splitlines()
+# Regular expression used for finding RGB values, each color channel is captured in its own group
+RGB_REGEX : re.Pattern = re.compile(r"rgb\(([0-9]+),([0-9]+),([0-9]+)\)")
 
-    for line in range(len(result)):
-        line_content : str = result[line]
+# Two-digit hex-values for every value of an RGB color channel, e.g. HEX_DIGITS[255] == "ff"
+# x == lowercase hexadecimal
+# 02 == string should be left-filled with zeroes to a length of 2 if needed
+HEX_DIGITS : tuple[str, ...] = tuple("{:02x}".format(value) for value in range(256))
 
-        if "<" in line_content or ">" in line_content:
-            result[line] = insert_escape_backslash_at_angle_brackets(line_content)
+def get_channel_header(channel_name : str) -> str:
+    """Returns a nice header for the current channel in the output script."""
+    return f"#\n#    Channel: {channel_name}\n#\n"
 
-    return result
+def run_channel_query(arguments : list[str]) -> typing.Optional[str]:
+    """
+    Run xfconf-query with the given arguments and return what it prints.
+    If it fails, a warning is shown and None is returned, so the caller can skip that channel or property.
+    """
+    result : subprocess.CompletedProcess = subprocess.run(["xfconf-query", *arguments], stdout=subprocess.PIPE, encoding="utf-8", env=XFCONF_ENVIRONMENT)
+    if result.returncode != 0:
+        # xfconf-query prints its own error message, so only say which command failed
+        click.echo("Warning: xfconf-query " + " ".join(arguments) + " failed with exit status " + str(result.returncode) + ", skipping it", err=True)
+        return None
+    return result.stdout
+
+def get_needed_channels(get_all : bool) -> list[str]:
+    """Get the specified channels using the command xfconf-query."""
+    # Without the list of channels there is nothing to export, so a failure here ends the program
+    listing : str = subprocess.run(["xfconf-query", "-l"], stdout=subprocess.PIPE, encoding="utf-8", env=XFCONF_ENVIRONMENT, check=True).stdout
+    # First line just reads "Channels:", unneeded
+    # Get all channels, or only channels for "visual" configurations
+    # that are available on the current system
+    return [
+        channel for channel in (line.strip() for line in listing.splitlines()[1:])
+        if get_all == True or channel in VISUAL_CHANNELS
+    ]
+
+def get_property_names(channel_name : str) -> typing.Optional[list[str]]:
+    """Get the names of all properties of the specified channel, or None if xfconf-query failed."""
+    output : typing.Optional[str] = run_channel_query(["-c", channel_name, "-l"])
+    if output is None:
+        return None
+    # Property names always start with a slash, an empty channel only prints a message instead
+    return [line for line in output.splitlines() if line.startswith("/")]
+
+def get_channel_listing(channel_name : str) -> typing.Optional[str]:
+    """Get the listing of all properties of the specified channel along with their values, or None if xfconf-query failed."""
+    # A single xfconf-query call lists every property of the channel along with its value
+    return run_channel_query(["-c", channel_name, "-lv"])
+
+def get_all_properties_of_channel(channel_name : str, property_names : list[str], listing : str) -> dict[str, str]:
+    """
+    Get all available properties of the specified channel together with their values.
+    The property names and the listing are the output of "xfconf-query -c CHANNEL -l"
+    and "xfconf-query -c CHANNEL -lv" for this channel.
+    Values are in the same form as "xfconf-query -c CHANNEL -p PROPERTY" prints them.
+    """
+    if not property_names:
+        return {}
+
+    # Both commands print the properties in the same order, one line each, unless
+    # some value spans several lines. Those can't be told apart from property lines reliably,
+    # so in that case nothing is taken from the listing.
+    values : dict[str, str] = {}
+    listing_lines : list[str] = listing.splitlines()
+    if len(listing_lines) == len(property_names):
+        # Every property name is padded with spaces so all values start in the same column
+        column : int = max(map(len, property_names)) + 2
+        for property_name, line in zip(property_names, listing_lines):
+            if line[:column] != property_name.ljust(column):
+                continue
+            value : str = line[column:]
+            # The listing can't express arrays properly
+            if not value.startswith(("[", "<<UNSUPPORTED>>")):
+                values[property_name] = value + "\n"
+
+    # Properties whose value can't be taken from the listing are queried one by one instead
+    # Properties whose query failed are left out
+    unknown_properties : list[str] = [name for name in property_names if name not in values]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        values.update(
+            (property_name, value)
+            for property_name, value in zip(unknown_properties, executor.map(functools.partial(get_property_value, channel_name), unknown_properties))
+            if value is not None
+        )
+
+    # Keep the order in which xfconf-query lists the properties
+    return {property_name: values[property_name] for property_name in property_names if property_name in values}
+
+# Remember values that were already queried, so asking for one again doesn't start a new process
+@functools.lru_cache(maxsize=None)
+def get_property_value(channel_name : str, property_name : str) -> typing.Optional[str]:
+    """Get the value of a single property exactly as xfconf-query prints it, or None if xfconf-query failed."""
+    return run_channel_query(["-c", channel_name, "-p", property_name])
 
 def insert_escape_backslash_at_angle_brackets(to_be_converted : str) -> str:
     """Insert the escape character at angle brackets so the resulting shell script will work."""
-    return to_be_converted.replace("<", "\\<").replace(">", "\\>")
+    return to_be_converted.translate(ANGLE_BRACKETS_TABLE)
 
 def insert_escape_backslash_at_double_quote(to_be_converted : str) -> str:
     """Insert the escape character at double quotes so the resulting script will set the correct values."""
-    return to_be_converted.replace("\"", "\\\"")
+    return to_be_converted.translate(DOUBLE_QUOTE_TABLE)
 
-def handle_array(property_value : str) -> list[str]:
+def handle_array(value_array : list[str]) -> list[str]:
     """Process a property holding an array of values, rather than a single value, correctly."""
-    # Split the string into an array of lines
-    value_array : list[str] = property_value.splitlines()
-    # Pop the first two because they're irrelevant
-    value_array.pop(0)
-    value_array.pop(0)
-    
-    for line in range(len(value_array)):
-        # If the current line in the value array is a number, replace commas with dots
-        if is_numeric(value_array[line]):
-            value_array[line] = handle_numeric(value_array[line])
+    for index, line in enumerate(value_array):
         # If the current line in the value array is a string, add double quotes around it and remove new line character
-        else:
+        # Numbers are kept as they are
+        if not is_numeric(line):
             # If there's double quotes already present, add escape character
-            if "\"" in value_array[line]:
-                value_array[line] = insert_escape_backslash_at_double_quote(value_array[line])
+            if "\"" in line:
+                line = insert_escape_backslash_at_double_quote(line)
             # Add double quotes around whole string and remove new line character
-            value_array[line] = "\"" + value_array[line].strip("\n") + "\""
+            value_array[index] = "\"" + line.rstrip("\n") + "\""
 
     return value_array
 
 def is_numeric(value : str) -> bool:
-    """Check if the given string is numeric."""
-    if re.search("[+0-9],[+0-9]", value) is not None or value.isdecimal():
-        return True
-    else:
-        return False
+    """Check if the given string is a whole number, which can be written without quotes."""
+    # xfconf-query runs in the C locale, so doubles never contain a decimal comma
+    # and anything else is safer as a quoted string
+    return value.isdecimal()
 
-def handle_numeric(value : str) -> bool:
-    """Convert commas (,) in the given string to dots (.)."""
-    return value.replace(",", ".")
-
-def handle_rgb(rgb_array : list[str]) -> list[str]:
+def rgb_to_hex(rgb_match : re.Match) -> str:
     """
-    Returns a hex-value array based on an array of rgb-values.
-    E.g.: ["rgb(255,255,255)", "rgb(0, 0, 0)"] is converted to ["#ffffff", "#000000"].
+    Returns a hex-value based on an rgb-value matched by RGB_REGEX.
+    E.g.: "rgb(255,0,255)" is converted to "#ff00ff".
     """
-    hex_array : list[str] = []
-    for value in rgb_array:
-        hex_array.append(rgb_to_hex(value))
-    return hex_array
+    r, g, b = map(int, rgb_match.groups())
+    # RGB_REGEX runs on every value, so not every match is a valid color, leave those as they are
+    if r > 255 or g > 255 or b > 255:
+        return rgb_match.group(0)
+    return "#" + HEX_DIGITS[r] + HEX_DIGITS[g] + HEX_DIGITS[b]
 
-def rgb_to_hex(rgb_string : str) -> str:
+def classify_value(property_value : str) -> tuple[str, typing.Union[str, list[str]]]:
     """
-    Returns a hex-value based on an rgb-value.
-    E.g.: "#ff00ff" is converted to "rgb(255,0,255)".
+    Classify the value of a property as "array", "numeric" or "string".
+    Returns the kind together with the value, with RGB values already converted to hex-values.
+    Array values are returned as a list of their items, other values without their trailing newline.
     """
-    tuple = re.findall(r"[0-9]+", rgb_string)
-    r = int(tuple[0])
-    g = int(tuple[1])
-    b = int(tuple[2])
-    # x == lowercase hexadecimal
-    # 02 == string should be left-filled with zeroes to a length of 2 if needed
-    return "#{:02x}{:02x}{:02x}".format(r, g, b)
+    # Handle RGB values, every match is replaced by its hex-value in one pass
+    # Most values don't contain any, the substring check is much cheaper than running the regex
+    if "rgb(" in property_value:
+        property_value = RGB_REGEX.sub(rgb_to_hex, property_value)
+
+    # Output such as "Value is an array with 1 items: \n\n value_1"
+    # xfconf-query always runs in English, so checking the start of the value is enough
+    if property_value.startswith(ARRAY_VALUE_PREFIX):
+        # Skip the first two lines because they're irrelevant
+        return ("array", property_value.splitlines()[2:])
+
+    # Only strip single values, an array may end with an empty item
+    property_value = property_value.rstrip("\n")
+    if is_numeric(property_value):
+        return ("numeric", property_value)
+    else:
+        return ("string", property_value)
 
 def check_script_name(script_name : str) -> str:
     """Appends '.sh' to the end of the script name if the file extension is not given yet."""
@@ -140,79 +216,80 @@ def get_destination_path(output : click.Path, script_name : str) -> str:
         output += "/"
     return output + script_name
 
-def main_loop(all_channels : bool) -> str:
+def get_channel_contents(all_channels : bool) -> list[tuple[str, dict[str, str]]]:
+    """
+    Get every needed channel together with all of its properties and their values.
+    All xfconf-query calls happen here, so nothing is written before they have all finished.
+    """
+    # The properties of all channels are listed by xfconf-query processes running at the same time
+    channels : list[str] = get_needed_channels(all_channels)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        property_names : typing.Iterator[typing.Optional[list[str]]] = executor.map(get_property_names, channels)
+        listings : typing.Iterator[typing.Optional[str]] = executor.map(get_channel_listing, channels)
+        # Channels that couldn't be listed are left out
+        return [
+            (channel, get_all_properties_of_channel(channel, names, listing))
+            for channel, names, listing in zip(channels, property_names, listings)
+            if names is not None and listing is not None
+        ]
+
+def main_loop(channel_contents : list[tuple[str, dict[str, str]]], final_script : typing.TextIO) -> None:
     """
     Main loop of the program.
-    Returns a string containing the content of the
-    finished shell script, using the utility functions
+    Writes the content of the finished shell script
+    to the given file, using the utility functions
     in this program to do so.
     """
-    # Regular expression used for finding RGB values
-    RGB_REGEX : str = r"rgb\([0-9]+,{1}[0-9]+,{1}[0-9]+\)"
-
-    # Holds the entire shell script that gets genereated in the form of a string
-    final_script_content : str = ""
+    # The script is written piece by piece instead of being built as one big string
+    write : typing.Callable[[str], int] = final_script.write
 
     # If it's the first loop, newlines won't be printed
     first : bool = True
 
-    # These properties of the thunar channel hold a string-value
-    # containing a comma-separated list of numbers
-    # As such, values of these properties should NOT be processed by handle_numeric()
-    # A dot-seperated list in these settings can / will prevent Thunar from starting
-    comma_separated_settings = ["/last-toolbar-item-order", "/last-toolbar-visible-buttons", "/last-details-view-column-widths"]
-
     # Loop through every channel
-    for channel in get_needed_channels(all_channels):
+    for channel, properties in channel_contents:
         # Space between channels, but not on the first one
         if first is True:
             first = False
         else:
-            final_script_content += "\n\n"
+            write("\n\n")
 
-        final_script_content += get_channel_header(channel)
+        write(get_channel_header(channel))
+        # Every line of this channel starts the same way
+        line_prefix : str = "xfconf-query -c " + channel + " -p "
 
         # Loop through every property in the current channel
-        for property in get_all_properties_of_channel(channel):
-            final_script_content += "xfconf-query -c " + channel + " -p " + property
-            property_value : str = os.popen("xfconf-query -c " + channel + " -p " + property).read()
-
-            # Handle RGB values   
-            if re.search(RGB_REGEX, property_value) is not None:
-                old_values : list[str] = re.findall(RGB_REGEX, property_value)
-                # concatenate list elements with ; as separator
-                old_string : str = ";".join(old_values)
-                new_values : list[str ]= handle_rgb(re.findall(RGB_REGEX, property_value))
-                new_string : str = ";".join(new_values)
-                property_value : str = property_value.replace(old_string, new_string)
+        for property, property_value in properties.items():
+            write(line_prefix)
+            # Angle brackets need to be escaped so the resulting shell script will work
+            if "<" in property or ">" in property:
+                write(insert_escape_backslash_at_angle_brackets(property))
+            else:
+                write(property)
+
+            kind, property_value = classify_value(property_value)
 
             # Handle arrays
-            property_value_lines : int = len(property_value.splitlines())
-            # Output such as "Value is an array with 1 items: \n\n value_1" has THREE lines
-            if property_value_lines >= 3:
+            if kind == "array":
                 property_value = handle_array(property_value)
                 # Every item in the array must be added individually like this
-                for line in property_value:
-                    final_script_content += " -s " + line
+                # The flags are joined first so they're written in one call
+                write(" -s " + " -s ".join(property_value))
                 # If value is an array with one item, add this needed flag
-                if property_value_lines == 3:
-                    final_script_content += " --force-array "
-            # Everything else
+                if len(property_value) == 1:
+                    write(" --force-array ")
+            # If the current value is a number, it's written as it is
+            elif kind == "numeric":
+                write(" -s " + property_value)
+            # If the current value is a string, add double quotes around it
             else:
-                # If the current value is a number, replace commas with dots
-                if is_numeric(property_value) and property not in comma_separated_settings:
-                    property_value = handle_numeric(property_value)
-                # If the current line in the value array is a string, add double quotes around it and remove new line character
-                else:
-                    # If there's double quotes already present, add escape character
-                    if "\"" in property_value:
-                        property_value = insert_escape_backslash_at_double_quote(property_value)
-                    # Add double quotes around whole string and remove new line character
-                    property_value = "\"" + property_value.strip("\n") + "\""
-                final_script_content += " -s " + property_value
-
-            final_script_content += "\n"
-    return final_script_content
+                # If there's double quotes already present, add escape character
+                if "\"" in property_value:
+                    property_value = insert_escape_backslash_at_double_quote(property_value)
+                # Add double quotes around whole string
+                write(" -s \"" + property_value + "\"")
+
+            write("\n")
 
 # Make sure that "-h" is a valid option as well
 CLICK_SETTINGS : dict = dict(help_option_names=["-h", "--help"])
@@ -234,10 +311,17 @@ def enter(all : bool, output : click.Path, script_name : str):
     script_name = check_script_name(script_name)
     
     final_path : str = get_destination_path(output, script_name)
-    final_script_content : str = main_loop(all)
 
-    # Write script string to file
-    with open(final_path, "w") as final_script:
-        final_script.write(final_script_content)
+    # Query everything before opening the file, so an existing script isn't truncated in the meantime
+    # xfconf-query prints its own error message, so only say which command failed
+    try:
+        channel_contents : list[tuple[str, dict[str, str]]] = get_channel_contents(all)
+    except subprocess.CalledProcessError as error:
+        raise click.ClickException(" ".join(error.cmd) + " failed with exit status " + str(error.returncode))
+
+    # Write script to file, the large buffer keeps the number of write calls low
+    # An explicit UTF-8 encoding doesn't depend on the locale and uses Python's fast encoder
+    with open(final_path, "w", buffering=WRITE_BUFFER_SIZE, encoding="utf-8") as final_script:
+        main_loop(channel_contents, final_script)
 
 enter()
\ No newline at end of file